@@ -0,0 +1,434 @@
+"""Offline load test for website.py.
+
+Seeds a throwaway database and upload folder, then drives every route either
+in-process through Flask's test client or over HTTP against a locally started
+multi-worker server, and reports throughput and p50/p95/p99 latency per route
+as JSON so runs can be compared.
+
+    python benchmark.py seed --dir /tmp/bench --users 10000 --images 1000000
+    python benchmark.py run --dir /tmp/bench --mode client --requests 500 -o before.json
+    python benchmark.py run --dir /tmp/bench --mode server --workers 4 --concurrency 16 -o after.json
+    python benchmark.py compare before.json after.json --threshold 10
+"""
+import argparse
+import http.cookiejar
+import io
+import json
+import math
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+PASSWORD = 'benchmark'
+ROUTES = ['login', 'main', 'main_page_n', 'feed', 'media', 'upload', 'settings', 'uploaded_file']
+
+
+# --------------------
+# Environment
+# --------------------
+def bench_env(directory):
+    # website.py reads these at import time, so set them before importing it
+    directory = os.path.abspath(directory)
+    return {
+        'DATABASE_PATH': os.path.join(directory, 'users.db'),
+        'UPLOAD_FOLDER': os.path.join(directory, 'uploads'),
+        'THUMBNAIL_FOLDER': os.path.join(directory, 'thumbnails'),
+        'JINJA_CACHE_DIR': os.path.join(directory, 'jinja_cache'),
+        # Every benchmark login comes from one address; measure hashing, not the limiter
+        'LOGIN_LIMIT_PER_IP': '1000000000',
+        'LOGIN_FAILURE_LIMIT_PER_USER': '1000000000',
+    }
+
+def import_website(directory):
+    os.environ.update(bench_env(directory))
+    sys.path.insert(0, HERE)
+    import website
+    return website
+
+def load_seed_info(directory):
+    with open(os.path.join(directory, 'seed.json')) as f:
+        return json.load(f)
+
+
+# --------------------
+# Seeding
+# --------------------
+def make_image(i):
+    # A real JPEG when Pillow is around, so thumbnails and hashing do real work
+    try:
+        from PIL import Image
+    except ImportError:
+        return os.urandom(100 * 1024), 'jpg'
+    rng = random.Random(i)
+    noise = Image.effect_noise((800, 600), rng.randint(20, 80))
+    im = Image.merge('RGB', (noise, noise.transpose(Image.FLIP_LEFT_RIGHT), Image.new('L', (800, 600), rng.randrange(256))))
+    out = io.BytesIO()
+    im.save(out, 'JPEG', quality=85)
+    return out.getvalue(), 'jpg'
+
+def seed(args):
+    if os.path.exists(os.path.join(args.dir, 'users.db')):
+        sys.exit(f"{args.dir} already has a users.db; pick an empty directory")
+    os.makedirs(args.dir, exist_ok=True)
+    website = import_website(args.dir)
+    from werkzeug.security import generate_password_hash
+
+    conn = website.acquire_connection()
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+
+    # Every user shares one hash: hashing 10k passwords would dominate seeding
+    hashed = generate_password_hash(PASSWORD)
+    for start in range(0, args.users, 10000):
+        stop = min(start + 10000, args.users)
+        conn.executemany("INSERT INTO users (username, password) VALUES (?, ?)",
+                         [(f"bench_user_{i}", hashed) for i in range(start, stop)])
+        conn.commit()
+    user_ids = [row[0] for row in conn.execute("SELECT id FROM users ORDER BY id")]
+
+    # A pool of distinct files shared by many rows, the way dedup stores them
+    blob_names = []
+    for i in range(args.distinct_files):
+        data, ext = make_image(i)
+        tmp_path, sha, size = website.hash_to_temp(io.BytesIO(data))
+        name, _ = website.add_blob(conn, tmp_path, sha, size, ext, refs=0)
+        blob_names.append(name)
+    conn.commit()
+
+    for start in range(0, args.images, 10000):
+        stop = min(start + 10000, args.images)
+        conn.executemany("INSERT INTO images (filename, user_id, privacy) VALUES (?, ?, ?)", [
+            (rng.choice(blob_names), rng.choice(user_ids), 'public' if rng.random() < args.public_ratio else 'private')
+            for _ in range(start, stop)
+        ])
+        conn.commit()
+    conn.execute("UPDATE blobs SET refcount = (SELECT COUNT(*) FROM images WHERE images.filename = blobs.name)")
+    conn.commit()
+    conn.execute("ANALYZE")
+    website.release_connection(conn)
+
+    info = {
+        'users': args.users,
+        'images': args.images,
+        'distinct_files': args.distinct_files,
+        'public_ratio': args.public_ratio,
+        'seed': args.seed,
+        'password': PASSWORD,
+        'max_image_id': args.images,
+        'blob_names': blob_names,
+    }
+    with open(os.path.join(args.dir, 'seed.json'), 'w') as f:
+        json.dump(info, f)
+    print(f"Seeded {args.users} users, {args.images} images ({args.distinct_files} files) "
+          f"in {time.monotonic() - started:.1f}s", file=sys.stderr)
+
+
+# --------------------
+# Measurement
+# --------------------
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return None
+    # Nearest-rank
+    index = min(len(sorted_values) - 1, max(0, math.ceil(p / 100 * len(sorted_values)) - 1))
+    return sorted_values[index]
+
+def summarize(latencies, errors, wall_seconds):
+    latencies = sorted(latencies)
+    count = len(latencies)
+    return {
+        'requests': count,
+        'errors': errors,
+        'throughput_rps': round(count / wall_seconds, 1) if wall_seconds else None,
+        'mean_ms': round(sum(latencies) / count * 1000, 3) if count else None,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3) if count else None,
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3) if count else None,
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3) if count else None,
+    }
+
+def pick_request(route, info, rng, upload_data):
+    # (method, path, form fields, file) for one request to `route`
+    username = f"bench_user_{rng.randrange(info['users'])}"
+    if route == 'login':
+        return 'POST', '/login', {'username': username, 'password': info['password']}, None
+    if route == 'main':
+        return 'GET', '/main', None, None
+    if route == 'main_page_n':
+        return 'GET', f"/main?before={rng.randint(1, info['max_image_id'])}", None, None
+    if route == 'feed':
+        return 'GET', f"/api/feed?before={rng.randint(1, info['max_image_id'])}", None, None
+    if route == 'media':
+        return 'GET', '/media', None, None
+    if route == 'settings':
+        return 'GET', '/settings', None, None
+    if route == 'upload':
+        # Trailing bytes after the JPEG end marker make each upload a new blob instead of a dedup hit
+        return 'POST', '/upload', {'privacy': rng.choice(['public', 'private'])}, ('bench.jpg', upload_data + rng.randbytes(16))
+    if route == 'uploaded_file':
+        return 'GET', f"/uploads/{rng.choice(info['blob_names'])}", None, None
+    raise ValueError(route)
+
+def is_ok(status):
+    return 200 <= status < 400
+
+
+# --------------------
+# In-process (Flask test client)
+# --------------------
+def run_client(args, info):
+    website = import_website(args.dir)
+    client = website.app.test_client()
+    rng = random.Random(args.seed)
+    upload_data, _ = make_image(-1)
+
+    # Media and settings are per-user, so log in as a user that owns images
+    client.post('/login', data={'username': 'bench_user_0', 'password': info['password']})
+
+    results = {}
+    for route in args.routes:
+        latencies, errors = [], 0
+        wall_started = time.perf_counter()
+        for _ in range(args.requests):
+            method, path, form, upload = pick_request(route, info, rng, upload_data)
+            if upload:
+                form = dict(form, image=(io.BytesIO(upload[1]), upload[0]))
+            started = time.perf_counter()
+            if method == 'GET':
+                response = client.get(path)
+            elif route == 'login':
+                # A separate client so the benchmark session stays logged in as bench_user_0
+                response = website.app.test_client().post(path, data=form)
+            else:
+                response = client.post(path, data=form, content_type='multipart/form-data')
+            latencies.append(time.perf_counter() - started)
+            errors += not is_ok(response.status_code)
+            response.close()
+        results[route] = summarize(latencies, errors, time.perf_counter() - wall_started)
+        print(f"{route:>14}: {results[route]}", file=sys.stderr)
+    return results
+
+
+# --------------------
+# Over HTTP (local multi-worker server)
+# --------------------
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def start_server(args, port):
+    # Returns the process and what actually ran, for the report
+    env = dict(os.environ, **bench_env(args.dir))
+    try:
+        import gunicorn  # noqa: F401
+        cmd = [sys.executable, '-m', 'gunicorn', '-w', str(args.workers), '--threads', str(args.threads),
+               '-b', f"127.0.0.1:{port}", '--log-level', 'warning', 'website:app']
+        setup = {'server': 'gunicorn', 'workers': args.workers, 'threads': args.threads}
+    except ImportError:
+        if not args.allow_fallback:
+            sys.exit("gunicorn is not installed; install it or pass --allow-fallback to use 'flask run'")
+        print("gunicorn not installed; falling back to a single-process 'flask run' server", file=sys.stderr)
+        cmd = [sys.executable, '-m', 'flask', '--app', 'website', 'run', '--port', str(port), '--with-threads']
+        setup = {'server': 'flask', 'workers': 1, 'threads': None}
+    log_path = os.path.join(args.dir, 'server.log')
+    with open(log_path, 'w') as log:
+        server = subprocess.Popen(cmd, cwd=HERE, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(('127.0.0.1', port), timeout=0.5):
+                return server, setup
+        except OSError:
+            if server.poll() is not None:
+                sys.exit(f"server exited during startup; see {log_path}")
+            time.sleep(0.2)
+    server.terminate()
+    sys.exit(f"server did not start within 30s; see {log_path}")
+
+def multipart(form, upload):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for key, value in form.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{key}"\r\n\r\n{value}\r\n'.encode())
+    filename, data = upload
+    parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="image"; filename="{filename}"\r\n'
+                 f'Content-Type: image/jpeg\r\n\r\n'.encode() + data + b'\r\n')
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+    # Measure the route itself, not the page it redirects to
+    def redirect_request(self, *args, **kwargs):
+        return None
+
+def http_client(base, info):
+    opener = urllib.request.build_opener(urllib.request.HTTPCookieProcessor(http.cookiejar.CookieJar()), NoRedirect)
+    send(opener, base, 'POST', '/login', {'username': 'bench_user_0', 'password': info['password']}, None)
+    return opener
+
+def send(opener, base, method, path, form, upload):
+    data, headers = None, {}
+    if upload:
+        data, headers['Content-Type'] = multipart(form, upload)
+    elif form is not None:
+        data = urllib.parse.urlencode(form).encode()
+    try:
+        with opener.open(urllib.request.Request(base + path, data=data, headers=headers, method=method)) as response:
+            response.read()
+            return response.status
+    except urllib.error.HTTPError as e:
+        return e.code
+
+def run_server(args, info):
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    server, setup = start_server(args, port)
+    upload_data, _ = make_image(-1)
+    results = {}
+    try:
+        clients = [http_client(base, info) for _ in range(args.concurrency)]
+        for route in args.routes:
+            per_worker = max(1, args.requests // args.concurrency)
+
+            def drive(worker):
+                rng = random.Random(args.seed * 1000 + worker)
+                # Logins get a fresh cookie jar so the worker's session is not replaced
+                opener = http_client(base, info) if route == 'login' else clients[worker]
+                latencies, errors = [], 0
+                for _ in range(per_worker):
+                    method, path, form, upload = pick_request(route, info, rng, upload_data)
+                    started = time.perf_counter()
+                    status = send(opener, base, method, path, form, upload)
+                    latencies.append(time.perf_counter() - started)
+                    errors += not is_ok(status)
+                return latencies, errors
+
+            wall_started = time.perf_counter()
+            with ThreadPoolExecutor(args.concurrency) as pool:
+                outcomes = list(pool.map(drive, range(args.concurrency)))
+            wall = time.perf_counter() - wall_started
+
+            latencies = [latency for worker_latencies, _ in outcomes for latency in worker_latencies]
+            results[route] = summarize(latencies, sum(errors for _, errors in outcomes), wall)
+            print(f"{route:>14}: {results[route]}", file=sys.stderr)
+    finally:
+        server.terminate()
+        server.wait()
+    return results, setup
+
+
+# --------------------
+# Commands
+# --------------------
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=HERE, capture_output=True, text=True).stdout.strip()
+    except OSError:
+        return None
+
+def run(args):
+    info = load_seed_info(args.dir)
+    if args.mode == 'client':
+        results, setup = run_client(args, info), {'server': None, 'workers': None, 'threads': None}
+    else:
+        results, setup = run_server(args, info)
+    report = {
+        'mode': args.mode,
+        **setup,
+        'concurrency': args.concurrency if args.mode == 'server' else 1,
+        'requests_per_route': args.requests,
+        'revision': git_revision(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'seed': {key: info[key] for key in ('users', 'images', 'distinct_files', 'public_ratio')},
+        'routes': results,
+    }
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+SETUP_KEYS = ('mode', 'server', 'workers', 'threads', 'concurrency')
+
+def compare(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    # Latencies from different servers or worker counts say nothing about the code
+    mismatched = [key for key in SETUP_KEYS if baseline.get(key) != candidate.get(key)]
+    if mismatched:
+        message = "reports were run differently: " + ', '.join(
+            f"{key} {baseline.get(key)!r} vs {candidate.get(key)!r}" for key in mismatched)
+        if not args.allow_mismatch:
+            sys.exit(message + " (pass --allow-mismatch to compare anyway)")
+        print("warning: " + message, file=sys.stderr)
+    baseline, candidate = baseline['routes'], candidate['routes']
+
+    regressions = []
+    print(f"{'route':>14} {'metric':>8} {'baseline':>10} {'candidate':>10} {'change':>8}")
+    for route in sorted(baseline.keys() & candidate.keys()):
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            old, new = baseline[route][metric], candidate[route][metric]
+            if not old or new is None:
+                continue
+            change = (new - old) / old * 100
+            flag = ' !' if change > args.threshold else ''
+            print(f"{route:>14} {metric:>8} {old:>10.2f} {new:>10.2f} {change:>+7.1f}%{flag}")
+            if flag:
+                regressions.append((route, metric))
+    if regressions:
+        sys.exit(f"{len(regressions)} latency regressions above {args.threshold}%")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    p = commands.add_parser('seed', help="create a throwaway users.db and uploads/")
+    p.add_argument('--dir', required=True)
+    p.add_argument('--users', type=int, default=10000)
+    p.add_argument('--images', type=int, default=100000)
+    p.add_argument('--distinct-files', type=int, default=200)
+    p.add_argument('--public-ratio', type=float, default=0.7)
+    p.add_argument('--seed', type=int, default=1)
+    p.set_defaults(func=seed)
+
+    p = commands.add_parser('run', help="drive every route and report latency")
+    p.add_argument('--dir', required=True)
+    p.add_argument('--mode', choices=['client', 'server'], default='client')
+    p.add_argument('--requests', type=int, default=200, help="requests per route")
+    p.add_argument('--routes', nargs='+', choices=ROUTES, default=ROUTES)
+    p.add_argument('--workers', type=int, default=4, help="server worker processes")
+    p.add_argument('--threads', type=int, default=4, help="threads per server worker")
+    p.add_argument('--concurrency', type=int, default=16, help="concurrent HTTP clients")
+    p.add_argument('--allow-fallback', action='store_true',
+                   help="use a single-process 'flask run' server when gunicorn is missing")
+    p.add_argument('--seed', type=int, default=1)
+    p.add_argument('-o', '--output', help="write the JSON report here instead of stdout")
+    p.set_defaults(func=run)
+
+    p = commands.add_parser('compare', help="diff two reports and fail on regressions")
+    p.add_argument('baseline')
+    p.add_argument('candidate')
+    p.add_argument('--threshold', type=float, default=10.0, help="allowed slowdown in percent")
+    p.add_argument('--allow-mismatch', action='store_true',
+                   help="compare reports from different modes, servers or worker counts")
+    p.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,38 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session, send_from_directory
+from flask import Flask, render_template, request, redirect, url_for, flash, session, send_file, jsonify, abort, g
+from flask import has_app_context, has_request_context, before_render_template, template_rendered
 import sqlite3
 from werkzeug.security import generate_password_hash, check_password_hash
-from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from collections import OrderedDict
+from jinja2 import FileSystemBytecodeCache
+from markupsafe import Markup
+import io
+import mimetypes
+import queue
 import uuid
 import os
 import random
+import re
+import hashlib
+import threading
+import time
+import click
+import cProfile
+import pstats
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # thumbnails are skipped without Pillow
+    Image = None
+
+try:
+    import numpy as np
+except ImportError:  # perceptual hashing is skipped without NumPy
+    np = None
 
 app = Flask(__name__)
 app.secret_key = 'One_Piece'
@@ -13,29 +41,333 @@ app.secret_key = 'One_Piece'
 def inject_background():
     return {'background': session.get('background', 'default-bg.jpg')}
 
-UPLOAD_FOLDER = 'uploads'
+app.config['DATABASE'] = os.environ.get('DATABASE_PATH', 'users.db')
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 8))
+SQLITE_PRAGMAS = (
+    "PRAGMA journal_mode = WAL",      # readers don't block the writer and vice versa
+    "PRAGMA synchronous = NORMAL",    # safe with WAL, skips an fsync per commit
+    "PRAGMA busy_timeout = 5000",     # wait for the write lock instead of 'database is locked'
+    "PRAGMA foreign_keys = ON",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA cache_size = -16000",     # 16 MB page cache per connection
+    "PRAGMA mmap_size = 134217728",
+)
+
+UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+PAGE_SIZE = 30
+
+THUMBNAIL_FOLDER = os.environ.get('THUMBNAIL_FOLDER', 'thumbnails')
+os.makedirs(THUMBNAIL_FOLDER, exist_ok=True)
+app.config['THUMBNAIL_FOLDER'] = THUMBNAIL_FOLDER
+THUMBNAIL_WIDTHS = (320, 640, 1280)
+THUMBNAIL_FORMATS = {'webp': 'WEBP', 'jpeg': 'JPEG'}
+THUMBNAIL_WORKERS = int(os.environ.get('THUMBNAIL_WORKERS', 2))
+
+# Serving of /uploads and /thumbs. SENDFILE_MODE hands the bytes to a front
+# proxy: 'x-accel' for nginx (`internal` locations at X_ACCEL_PREFIX aliasing
+# the upload folder and at X_ACCEL_THUMBS_PREFIX aliasing the thumbnail
+# folder), 'x-sendfile' for Apache/lighttpd.
+UPLOAD_MAX_AGE = 365 * 24 * 3600
+app.config['SENDFILE_MODE'] = os.environ.get('SENDFILE_MODE')
+app.config['X_ACCEL_PREFIX'] = os.environ.get('X_ACCEL_PREFIX', '/_protected/')
+app.config['X_ACCEL_THUMBS_PREFIX'] = os.environ.get('X_ACCEL_THUMBS_PREFIX', '/_protected_thumbs/')
+
+# Behind such a proxy every request comes from the proxy's address, which
+# would make the per-IP login limit one limit for the whole site. Set
+# TRUSTED_PROXIES to the number of proxies in front of the app to take the
+# client address (and scheme) from X-Forwarded-For/-Proto. Leave it at 0 when
+# clients reach the app directly, or they could spoof those headers.
+TRUSTED_PROXIES = int(os.environ.get('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES, x_proto=TRUSTED_PROXIES)
+HOT_FILE_MAX_BYTES = 256 * 1024
+HOT_CACHE_MAX_BYTES = int(os.environ.get('HOT_CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+FRAGMENT_CACHE_MAX_BYTES = int(os.environ.get('FRAGMENT_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(os.environ.get('JINJA_CACHE_DIR', '.jinja_cache'))
+os.makedirs(app.jinja_env.bytecode_cache.directory, exist_ok=True)
+
+# Requests slower than this are logged; a PROFILE_SAMPLE_RATE fraction of
+# requests run under cProfile so a slow one can attach its profile
+SLOW_REQUEST_SECONDS = float(os.environ.get('SLOW_REQUEST_SECONDS', 1.0))
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 0.0))
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+
+# Password hashing runs in its own process pool. At most PASSWORD_QUEUE_LIMIT
+# hashes may be queued or running; beyond that requests are turned away
+# instead of tying up web workers. Limits are per worker process.
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'scrypt')
+PASSWORD_WORKERS = int(os.environ.get('PASSWORD_WORKERS', os.cpu_count() or 2))
+PASSWORD_QUEUE_LIMIT = int(os.environ.get('PASSWORD_QUEUE_LIMIT', PASSWORD_WORKERS * 4))
+PASSWORD_HASH_TIMEOUT = 10
+LOGIN_LIMIT_PER_IP = int(os.environ.get('LOGIN_LIMIT_PER_IP', 30))              # attempts per window
+LOGIN_FAILURE_LIMIT_PER_USER = int(os.environ.get('LOGIN_FAILURE_LIMIT_PER_USER', 5))  # failures per window
+RATE_LIMIT_WINDOW = 60
+
+# Perceptual hashes: a 64-bit DCT hash per image, searched by Hamming distance
+PHASH_INDEX_PATH = os.environ.get('PHASH_INDEX_PATH', 'phash_index.npy')
+PHASH_DUPLICATE_DISTANCE = 4   # at or below this an upload is flagged as a near-duplicate
+PHASH_SIMILAR_DISTANCE = 12    # default radius for /api/similar
+PHASH_TAIL_LIMIT = 1000        # unindexed rows searched per lookup; reaching it triggers a rebuild
+PHASH_WARNING_TIMEOUT = 1.0    # how long an upload waits on its hash for the duplicate warning
+app.config['DUPLICATE_WARNING'] = os.environ.get('DUPLICATE_WARNING', '1') == '1'
 
 # --------------------
-# Database setup
+# Metrics
 # --------------------
-def init_db():
-    conn = sqlite3.connect('users.db')
-    c = conn.cursor()
+# Per-process metrics in Prometheus text format, served on /metrics. With
+# several worker processes each one reports its own numbers, so scrape the
+# workers individually (or sum them) rather than through a load balancer.
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+class Counter:
+    def __init__(self, name, help_text, labels=()):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{format_labels(self.labels, key)} {value}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help_text, labels=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, labels, buckets
+        self.values = {}  # label values -> [per-bucket counts..., +Inf count, sum]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(label, '') for label in self.labels)
+        with self.lock:
+            counts = self.values.setdefault(key, [0] * (len(self.buckets) + 2))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def expose(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, counts in sorted(self.values.items()):
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    names, values = self.labels + ('le',), key + (str(bound),)
+                    lines.append(f"{self.name}_bucket{format_labels(names, values)} {count}")
+                lines.append(f"{self.name}_count{format_labels(self.labels, key)} {counts[-2]}")
+                lines.append(f"{self.name}_sum{format_labels(self.labels, key)} {counts[-1]}")
+        return lines
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    pairs = (f'{name}="{str(value).replace(chr(92), chr(92) * 2).replace(chr(34), chr(92) + chr(34))}"'
+             for name, value in zip(names, values))
+    return '{' + ','.join(pairs) + '}'
+
+REQUEST_SECONDS = Histogram('http_request_duration_seconds', "Time spent handling a request.", ('endpoint', 'method'))
+REQUESTS = Counter('http_requests_total', "Requests handled, by status code.", ('endpoint', 'method', 'status'))
+SQL_SECONDS = Histogram('sql_query_duration_seconds', "Time spent in a single SQL statement.", ('endpoint',))
+SQL_PER_REQUEST = Histogram('sql_queries_per_request', "SQL statements run by one request.", ('endpoint',), COUNT_BUCKETS)
+TEMPLATE_SECONDS = Histogram('template_render_duration_seconds', "Time spent rendering a template.", ('template',))
+PASSWORD_HASH_SECONDS = Histogram('password_hash_duration_seconds', "Time spent hashing or checking a password.", ('operation',))
+PASSWORD_REJECTIONS = Counter('password_hash_rejections_total', "Password hashing requests turned away.", ('reason',))
+FS_OPERATIONS = Counter('filesystem_operations_total', "Filesystem calls made for uploads and thumbnails.", ('operation',))
+UPLOAD_BYTES = Counter('upload_bytes_total', "Bytes received in uploaded files.")
+SERVED_BYTES = Counter('served_file_bytes_total', "Bytes of stored files sent by the app itself.", ('source',))
+METRICS = [REQUEST_SECONDS, REQUESTS, SQL_SECONDS, SQL_PER_REQUEST, TEMPLATE_SECONDS,
+           PASSWORD_HASH_SECONDS, PASSWORD_REJECTIONS, FS_OPERATIONS, UPLOAD_BYTES, SERVED_BYTES]
+
+def current_endpoint():
+    if has_request_context():
+        return request.endpoint or 'unknown'
+    return 'background'
+
+class InstrumentedCursor(sqlite3.Cursor):
+    # sqlite3 steps only the first row inside execute(); the rest are read
+    # while fetching. A statement's time therefore keeps adding up until its
+    # rows run out (or the cursor is re-executed, closed or dropped).
+    pending = None
+
+    def add_time(self, seconds):
+        self.pending = (self.pending or 0.0) + seconds
+
+    def finish(self):
+        if self.pending is not None:
+            record_query(self.pending)
+            self.pending = None
+
+    def timed_execute(self, method, *args, **kwargs):
+        self.finish()
+        started = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            self.add_time(time.perf_counter() - started)
+            if self.description is None:
+                self.finish()  # no rows to fetch
+
+    def timed_fetch(self, method, *args):
+        started = time.perf_counter()
+        try:
+            result = method(*args)
+        except StopIteration:
+            self.add_time(time.perf_counter() - started)
+            self.finish()
+            raise
+        self.add_time(time.perf_counter() - started)
+        if result is None or result == []:
+            self.finish()
+        return result
+
+    def execute(self, *args, **kwargs):
+        return self.timed_execute(super().execute, *args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.timed_execute(super().executemany, *args, **kwargs)
+
+    def fetchone(self):
+        return self.timed_fetch(super().fetchone)
+
+    def fetchmany(self, *args):
+        return self.timed_fetch(super().fetchmany, *args)
+
+    def fetchall(self):
+        rows = self.timed_fetch(super().fetchall)
+        self.finish()
+        return rows
+
+    def __next__(self):
+        return self.timed_fetch(super().__next__)
+
+    def close(self):
+        self.finish()
+        super().close()
+
+    def __del__(self):
+        self.finish()
+
+class InstrumentedConnection(sqlite3.Connection):
+    # Times every statement, fetches included, and tallies it against the current request
+    def cursor(self, factory=InstrumentedCursor):
+        return super().cursor(factory)
+
+    def execute(self, *args, **kwargs):
+        return self.cursor().execute(*args, **kwargs)
+
+    def executemany(self, *args, **kwargs):
+        return self.cursor().executemany(*args, **kwargs)
 
-    # Users table
-    c.execute('''
+def record_query(seconds):
+    SQL_SECONDS.observe(seconds, endpoint=current_endpoint())
+    if has_request_context():
+        g.sql_count = g.get('sql_count', 0) + 1
+        g.sql_seconds = g.get('sql_seconds', 0.0) + seconds
+
+def count_fs(operation, n=1):
+    FS_OPERATIONS.inc(n, operation=operation)
+
+# Only one profiler can be active per process (enforced from Python 3.12), so
+# a sampled request is skipped when another thread is already profiling
+_profiler_lock = threading.Lock()
+
+def stop_profiler():
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profiler_lock.release()
+    return profiler
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+    if PROFILE_SAMPLE_RATE and random.random() < PROFILE_SAMPLE_RATE and _profiler_lock.acquire(blocking=False):
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:  # some other tool (debugger, coverage) owns the profiler hook
+            _profiler_lock.release()
+        else:
+            g.profiler = profiler
+
+@app.after_request
+def record_request(response):
+    started = g.pop('request_started', None)
+    if started is None:
+        return response
+    elapsed = time.perf_counter() - started
+    profiler = stop_profiler()
+
+    endpoint = request.endpoint or 'unknown'
+    REQUEST_SECONDS.observe(elapsed, endpoint=endpoint, method=request.method)
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    SQL_PER_REQUEST.observe(g.get('sql_count', 0), endpoint=endpoint)
+
+    if elapsed >= SLOW_REQUEST_SECONDS:
+        message = (f"Slow request: {request.method} {request.full_path} -> {response.status_code} "
+                   f"in {elapsed * 1000:.0f} ms ({g.get('sql_count', 0)} SQL statements, "
+                   f"{g.get('sql_seconds', 0.0) * 1000:.0f} ms SQL, "
+                   f"{g.get('template_seconds', 0.0) * 1000:.0f} ms templates)")
+        if profiler is not None:
+            out = io.StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(25)
+            message += "\n" + out.getvalue()
+        app.logger.warning(message)
+    return response
+
+@app.teardown_request
+def release_profiler(exc):
+    # after_request doesn't run when a view raises
+    stop_profiler()
+
+@before_render_template.connect_via(app)
+def start_template_timer(sender, template, context, **extra):
+    if has_app_context():
+        g.setdefault('template_starts', []).append(time.perf_counter())
+
+@template_rendered.connect_via(app)
+def record_template(sender, template, context, **extra):
+    if has_app_context() and g.get('template_starts'):
+        elapsed = time.perf_counter() - g.template_starts.pop()
+        g.template_seconds = g.get('template_seconds', 0.0) + elapsed
+        TEMPLATE_SECONDS.observe(elapsed, template=template.name)
+
+@app.route('/metrics')
+def metrics():
+    token = app.config['METRICS_TOKEN']
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.expose())
+    return app.response_class("\n".join(lines) + "\n", mimetype='text/plain; version=0.0.4')
+
+# --------------------
+# Database setup
+# --------------------
+# Schema changes are numbered migrations applied in order, each in its own
+# transaction; PRAGMA user_version records how many have run. Only ever
+# append to MIGRATIONS, never edit an entry that has shipped.
+def migrate_base_tables(conn):
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS users (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             username TEXT UNIQUE NOT NULL,
             password TEXT NOT NULL
         )
     ''')
-
-    # Images table
-    c.execute('''
+    conn.execute('''
         CREATE TABLE IF NOT EXISTS images (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             filename TEXT NOT NULL,
@@ -44,13 +376,107 @@ def init_db():
         )
     ''')
 
-    # Add background column if it doesn't exist
-    try:
-        c.execute("ALTER TABLE users ADD COLUMN background TEXT DEFAULT 'background_red.jpg'")
-    except sqlite3.OperationalError:
-        pass  # column exists
+def migrate_user_background(conn):
+    columns = [row['name'] for row in conn.execute("PRAGMA table_info(users)")]
+    if 'background' not in columns:
+        conn.execute("ALTER TABLE users ADD COLUMN background TEXT DEFAULT 'background_red.jpg'")
+
+def migrate_feed_indexes(conn):
+    # Indexes for the keyset-paginated gallery and media feeds
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_privacy_id ON images (privacy, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_uploader_id ON images (uploader, id)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_images_filename ON images (filename)")
+
+def migrate_image_derivatives(conn):
+    # Resized copies of each upload, keyed by the original's filename
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS image_derivatives (
+            source TEXT NOT NULL,
+            width INTEGER NOT NULL,
+            format TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            PRIMARY KEY (source, width, format)
+        )
+    ''')
+
+def migrate_blobs(conn):
+    # Content-addressed upload storage: one file per distinct SHA-256,
+    # shared by every images row whose filename is the blob's name
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS blobs (
+            hash TEXT PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+
+def migrate_images_user_id(conn):
+    # Point images at users.id instead of copying the username, so a rename
+    # touches one row. Images whose uploader no longer exists are dropped;
+    # their files are released by the next reconcile-uploads.
+    conn.execute('''
+        CREATE TABLE images_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filename TEXT NOT NULL,
+            user_id INTEGER NOT NULL REFERENCES users (id) ON DELETE CASCADE,
+            privacy TEXT NOT NULL CHECK(privacy IN ('private', 'public'))
+        )
+    ''')
+    conn.execute('''
+        INSERT INTO images_new (id, filename, user_id, privacy)
+        SELECT images.id, images.filename, users.id, images.privacy
+        FROM images JOIN users ON users.username = images.uploader
+    ''')
+    conn.execute("DROP TABLE images")
+    conn.execute("ALTER TABLE images_new RENAME TO images")
+    conn.execute("CREATE INDEX idx_images_privacy_id ON images (privacy, id)")
+    conn.execute("CREATE INDEX idx_images_user_id ON images (user_id, id)")
+    conn.execute("CREATE INDEX idx_images_filename ON images (filename)")
+    conn.execute("UPDATE blobs SET refcount = (SELECT COUNT(*) FROM images WHERE images.filename = blobs.name)")
+
+def migrate_cache_versions(conn):
+    # Bumped on every write that changes a cached page; part of each cache key,
+    # so an invalidation in one worker (or the CLI) is seen by all of them
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS cache_versions (
+            namespace TEXT PRIMARY KEY,
+            version INTEGER NOT NULL
+        )
+    ''')
+
+def migrate_images_phash(conn):
+    # 64-bit perceptual hash, stored as a signed SQLite integer
+    conn.execute("ALTER TABLE images ADD COLUMN phash INTEGER")
+
+MIGRATIONS = [
+    migrate_base_tables,
+    migrate_user_background,
+    migrate_feed_indexes,
+    migrate_image_derivatives,
+    migrate_blobs,
+    migrate_images_user_id,
+    migrate_cache_versions,
+    migrate_images_phash,
+]
 
-    conn.commit()
+def init_db():
+    conn = connect_db()
+    while True:
+        # Take the write lock before reading the version so concurrent
+        # workers starting up never apply the same migration twice
+        conn.execute("BEGIN IMMEDIATE")
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        if version >= len(MIGRATIONS):
+            conn.rollback()
+            break
+        try:
+            MIGRATIONS[version](conn)
+            conn.execute(f"PRAGMA user_version = {version + 1}")
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
     conn.close()
 
 
@@ -60,11 +486,751 @@ def init_db():
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def get_db_connection():
-    conn = sqlite3.connect("users.db")
+def connect_db():
+    # cached_statements keeps prepared statements around for the life of the pooled connection
+    conn = sqlite3.connect(app.config['DATABASE'], timeout=5, check_same_thread=False, cached_statements=256,
+                           factory=InstrumentedConnection)
     conn.row_factory = sqlite3.Row
+    for pragma in SQLITE_PRAGMAS:
+        conn.execute(pragma)
     return conn
 
+# LIFO so the most recently used (warmest) connection is handed out first
+_db_pool = queue.LifoQueue(maxsize=DB_POOL_SIZE)
+
+def acquire_connection():
+    try:
+        return _db_pool.get_nowait()
+    except queue.Empty:
+        return connect_db()
+
+def release_connection(conn):
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _db_pool.put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+def get_db_connection():
+    # One pooled connection per app/request context, returned on teardown
+    if 'db' not in g:
+        g.db = acquire_connection()
+    return g.db
+
+@app.teardown_appcontext
+def return_db_connection(exc):
+    conn = g.pop('db', None)
+    if conn is not None:
+        release_connection(conn)
+
+init_db()
+
+class SizedLRU:
+    # LRU of str/bytes values, bounded by their total length
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.items.get(key)
+            if value is not None:
+                self.items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        if len(value) > self.max_bytes:
+            return
+        with self.lock:
+            if key in self.items:
+                return
+            self.items[key] = value
+            self.size += len(value)
+            while self.size > self.max_bytes:
+                _, evicted = self.items.popitem(last=False)
+                self.size -= len(evicted)
+
+def get_cursor():
+    # Pages are addressed by the id of the last image already shown (?before=<id>)
+    return request.args.get('before', type=int)
+
+def fetch_page(conn, where, params, before=None, limit=PAGE_SIZE):
+    # Keyset pagination over id: every page is a single index range scan,
+    # so page N costs the same as page 1. Returns (rows, next_cursor).
+    sql = ("SELECT images.id, images.filename, users.username AS uploader, images.privacy "
+           f"FROM images JOIN users ON users.id = images.user_id WHERE {where}")
+    params = list(params)
+    if before is not None:
+        sql += " AND images.id < ?"
+        params.append(before)
+    sql += " ORDER BY images.id DESC LIMIT ?"
+    params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    next_cursor = rows[limit - 1]['id'] if len(rows) > limit else None
+    return rows[:limit], next_cursor
+
+def fetch_public_page(conn, before=None, limit=PAGE_SIZE):
+    return fetch_page(conn, "images.privacy = 'public'", (), before, limit)
+
+def fetch_user_page(conn, user_id, before=None, limit=PAGE_SIZE):
+    return fetch_page(conn, "images.user_id = ?", (user_id,), before, limit)
+
+def current_user_id():
+    # Sessions from before images were keyed by user id only carry the username
+    if 'user_id' not in session:
+        user = get_db_connection().execute("SELECT id FROM users WHERE username = ?", (session['username'],)).fetchone()
+        if user is None:
+            session.clear()
+            abort(redirect(url_for('login')))
+        session['user_id'] = user['id']
+    return session['user_id']
+
+def feed_json(images, next_cursor, srcsets):
+    return app.json.dumps({
+        'images': [{
+            'id': img['id'],
+            'url': url_for('uploaded_file', filename=img['filename']),
+            'srcset': srcsets.get(img['filename'], {}),
+            'uploader': img['uploader'],
+            'privacy': img['privacy'],
+        } for img in images],
+        'next_cursor': next_cursor,
+    })
+
+def json_response(body):
+    return app.response_class(body, mimetype='application/json')
+
+# --------------------
+# Page cache
+# --------------------
+# Rendered grids and JSON feed pages are cached by page cursor. Each key
+# carries the current version of the namespaces it depends on, so writes
+# invalidate by bumping a version (see invalidate()) instead of hunting keys:
+#   'images'     - everything (reconciler, storage migration)
+#   'gallery'    - the public gallery and /api/feed
+#   'user:<id>'  - that user's media, settings and /api/media
+fragments = SizedLRU(FRAGMENT_CACHE_MAX_BYTES)
+
+def user_namespace(user_id):
+    return f"user:{user_id}"
+
+def cache_versions(conn, namespaces):
+    placeholders = ','.join('?' * len(namespaces))
+    rows = conn.execute(f"SELECT namespace, version FROM cache_versions WHERE namespace IN ({placeholders})",
+                        namespaces).fetchall()
+    versions = {row['namespace']: row['version'] for row in rows}
+    return tuple(versions.get(ns, 0) for ns in namespaces)
+
+def invalidate(conn, *namespaces):
+    # Runs inside the caller's write transaction and is committed with it
+    conn.executemany('''
+        INSERT INTO cache_versions (namespace, version) VALUES (?, 1)
+        ON CONFLICT (namespace) DO UPDATE SET version = version + 1
+    ''', [(ns,) for ns in namespaces])
+
+def cached(conn, namespaces, key, build):
+    # Versions are read before building, so a write racing the build can
+    # only leave newer data under the older key, never the reverse
+    namespaces = ('images',) + tuple(namespaces)
+    full_key = key + cache_versions(conn, namespaces)
+    value = fragments.get(full_key)
+    if value is None:
+        value = build()
+        fragments.put(full_key, value)
+    return value
+
+# --------------------
+# Upload storage
+# --------------------
+# Uploads are stored once per distinct content as <sha256>.<ext> under
+# sharded directories (uploads/ab/cd/<sha256>.<ext>). images.filename holds
+# that name and blobs.refcount counts the rows sharing it. Files uploaded
+# before this layout keep their flat uuid_name until `flask migrate-storage`.
+CHUNK_SIZE = 1024 * 1024
+BLOB_NAME = re.compile(r'^[0-9a-f]{64}\.[a-z0-9]+$')
+
+def storage_relpath(name):
+    if BLOB_NAME.match(name):
+        return os.path.join(name[:2], name[2:4], name)
+    return name  # legacy flat upload
+
+def storage_path(name):
+    return os.path.join(app.config['UPLOAD_FOLDER'], storage_relpath(name))
+
+def hash_to_temp(stream):
+    # Stream to a temp file, hashing in the same pass; returns (temp_path, sha256, size)
+    tmp_dir = os.path.join(app.config['UPLOAD_FOLDER'], '.tmp')
+    os.makedirs(tmp_dir, exist_ok=True)
+    tmp_path = os.path.join(tmp_dir, uuid.uuid4().hex)
+    digest = hashlib.sha256()
+    size = 0
+    try:
+        with open(tmp_path, 'wb') as out:
+            while chunk := stream.read(CHUNK_SIZE):
+                digest.update(chunk)
+                out.write(chunk)
+                size += len(chunk)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+    count_fs('write')
+    return tmp_path, digest.hexdigest(), size
+
+def add_blob(conn, tmp_path, sha, size, ext, refs=1):
+    # Move a hashed temp file into place (or drop it if the content is already
+    # stored) and take `refs` references. Returns (name, is_new_file).
+    # The write lock is held from the existence check until the caller
+    # commits, so drop_unreferenced_blobs can't remove the file in between.
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    name = f"{sha}.{ext}"
+    existing = conn.execute("SELECT name FROM blobs WHERE hash = ?", (sha,)).fetchone()
+    if existing:
+        name = existing[0]
+
+    final_path = storage_path(name)
+    is_new_file = not os.path.exists(final_path)
+    count_fs('stat')
+    if is_new_file:
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        os.replace(tmp_path, final_path)
+        count_fs('rename')
+    else:
+        os.remove(tmp_path)
+        count_fs('remove')
+
+    conn.execute('''
+        INSERT INTO blobs (hash, name, size, refcount) VALUES (?, ?, ?, ?)
+        ON CONFLICT (hash) DO UPDATE SET refcount = refcount + excluded.refcount
+    ''', (sha, name, size, refs))
+    return name, is_new_file
+
+def store_upload(conn, file, ext):
+    # Caller commits together with the images row that holds the reference
+    tmp_path, sha, size = hash_to_temp(file.stream)
+    UPLOAD_BYTES.inc(size)
+    return add_blob(conn, tmp_path, sha, size, ext)
+
+def drop_unreferenced_blobs(conn):
+    # Remove blobs no images row points at any more, with their files and thumbnails.
+    # Files go while the write lock is held, so an add_blob can't re-reference
+    # one between the delete and the remove.
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        names = [row[0] for row in conn.execute("DELETE FROM blobs WHERE refcount <= 0 RETURNING name").fetchall()]
+        for name in names:
+            try:
+                os.remove(storage_path(name))
+            except FileNotFoundError:
+                pass
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    count_fs('remove', len(names))
+    delete_derivatives(conn, names)
+    return len(names)
+
+# --------------------
+# Serving stored files
+# --------------------
+# Every name under /uploads and /thumbs is written once and never changes
+# (content hash or uuid prefix), so responses are cacheable forever and the
+# ETag can be derived from the name without touching the disk.
+hot_files = SizedLRU(HOT_CACHE_MAX_BYTES)
+
+def name_etag(name):
+    stem = name.rsplit('.', 1)[0]
+    if re.fullmatch(r'[0-9a-f]{64}(_\d+)?', stem):
+        return stem
+    return hashlib.sha256(name.encode()).hexdigest()
+
+def cache_forever(response):
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = UPLOAD_MAX_AGE
+    response.cache_control.immutable = True
+    return response
+
+def send_immutable(folder, relpath, name, accel_prefix):
+    etag = name_etag(name)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+        response.set_etag(etag)
+        return cache_forever(response)
+
+    path = safe_join(folder, relpath)
+    if path is None:
+        abort(404)
+    mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    mode = app.config['SENDFILE_MODE']
+    if mode == 'x-accel':
+        # nginx answers Range and streams the file itself
+        response = app.response_class(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = accel_prefix + relpath.replace(os.sep, '/')
+        response.set_etag(etag)
+        return cache_forever(response)
+
+    data = hot_files.get(path)
+    from_memory = data is not None
+    if data is None and mode != 'x-sendfile':
+        count_fs('stat')
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            abort(404)
+        if size <= HOT_FILE_MAX_BYTES:
+            count_fs('read')
+            with open(path, 'rb') as f:
+                data = f.read()
+            hot_files.put(path, data)
+
+    if data is not None:
+        response = send_file(io.BytesIO(data), mimetype=mimetype, etag=etag, conditional=True,
+                             max_age=UPLOAD_MAX_AGE)
+        SERVED_BYTES.inc(response.content_length or 0, source='memory' if from_memory else 'disk')
+    elif mode == 'x-sendfile':
+        count_fs('stat')
+        if not os.path.isfile(path):
+            abort(404)
+        response = app.response_class(mimetype=mimetype)
+        response.headers['X-Sendfile'] = os.path.abspath(path)
+        response.set_etag(etag)
+    else:
+        count_fs('read')
+        response = send_file(path, mimetype=mimetype, etag=etag, conditional=True, max_age=UPLOAD_MAX_AGE)
+        SERVED_BYTES.inc(response.content_length or 0, source='disk')
+    return cache_forever(response)
+
+# --------------------
+# Image derivatives (thumbnails)
+# --------------------
+def render_derivatives(src_path, source, dest_folder):
+    # Runs in the thumbnail process pool, so it must not touch the app or DB.
+    # Returns [(width, format, filename), ...] for what was written.
+    stem = source.rsplit('.', 1)[0]
+    written = []
+    with Image.open(src_path) as im:
+        if getattr(im, 'is_animated', False):
+            return written  # keep animated GIFs as they are
+        im = ImageOps.exif_transpose(im)
+        has_alpha = im.mode in ('RGBA', 'LA') or 'transparency' in im.info
+        im = im.convert('RGBA' if has_alpha else 'RGB')
+
+        # Never upscale; an image narrower than the smallest width gets one copy at its own size
+        widths = [w for w in THUMBNAIL_WIDTHS if w < im.width] or [im.width]
+        for width in widths:
+            height = max(1, round(im.height * width / im.width))
+            resized = im.resize((width, height), Image.LANCZOS)
+            for fmt, pil_format in THUMBNAIL_FORMATS.items():
+                out = resized.convert('RGB') if fmt == 'jpeg' else resized
+                filename = f"{stem}_{width}.{'jpg' if fmt == 'jpeg' else fmt}"
+                out.save(os.path.join(dest_folder, filename), pil_format, quality=80)
+                written.append((width, fmt, filename))
+    return written
+
+_thumbnail_pool = None
+_thumbnail_pool_lock = threading.Lock()
+
+def get_thumbnail_pool():
+    global _thumbnail_pool
+    with _thumbnail_pool_lock:
+        if _thumbnail_pool is None:
+            _thumbnail_pool = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS)
+        return _thumbnail_pool
+
+def submit_image_job(fn, *args):
+    # One dead worker (OOM on a huge image, a Pillow crash, a kill) breaks the
+    # whole executor for good, so swap in a fresh pool and resubmit once
+    global _thumbnail_pool
+    pool = get_thumbnail_pool()
+    try:
+        return pool.submit(fn, *args)
+    except BrokenProcessPool:
+        app.logger.warning("Thumbnail pool broken; starting a new one")
+        with _thumbnail_pool_lock:
+            if _thumbnail_pool is pool:
+                _thumbnail_pool = None
+        pool.shutdown(wait=False)
+        return get_thumbnail_pool().submit(fn, *args)
+
+def submit_derivatives(source):
+    src_path = storage_path(source)
+    return submit_image_job(render_derivatives, src_path, source, app.config['THUMBNAIL_FOLDER'])
+
+def record_derivatives(source, derivatives):
+    # Called from pool callback threads, outside any request
+    conn = acquire_connection()
+    try:
+        conn.executemany("INSERT OR REPLACE INTO image_derivatives (source, width, format, filename) VALUES (?, ?, ?, ?)",
+                         [(source, width, fmt, filename) for width, fmt, filename in derivatives])
+        # Pages showing this image can now use the srcset
+        owners = conn.execute("SELECT DISTINCT user_id FROM images WHERE filename = ?", (source,)).fetchall()
+        invalidate(conn, 'gallery', *(user_namespace(row['user_id']) for row in owners))
+        conn.commit()
+    finally:
+        release_connection(conn)  # rolls back if the commit never happened
+
+def schedule_derivatives(source):
+    # Fire and forget: the upload request returns while the pool renders
+    if Image is None:
+        return
+
+    def done(future):
+        try:
+            record_derivatives(source, future.result())
+        except Exception:
+            app.logger.exception("Thumbnail generation failed for %s", source)
+
+    # The upload is already committed; `flask backfill-thumbnails` can catch up later
+    try:
+        submit_derivatives(source).add_done_callback(done)
+    except Exception:
+        app.logger.exception("Could not schedule thumbnails for %s", source)
+
+def delete_derivatives(conn, sources):
+    sources = list(sources)
+    for i in range(0, len(sources), 500):
+        batch = sources[i:i + 500]
+        placeholders = ','.join('?' * len(batch))
+        rows = conn.execute(f"SELECT filename FROM image_derivatives WHERE source IN ({placeholders})", batch).fetchall()
+        conn.execute(f"DELETE FROM image_derivatives WHERE source IN ({placeholders})", batch)
+        conn.commit()
+        for row in rows:
+            try:
+                os.remove(os.path.join(app.config['THUMBNAIL_FOLDER'], row[0]))
+            except FileNotFoundError:
+                pass
+        count_fs('remove', len(rows))
+
+def get_srcsets(conn, images):
+    # {source: {'webp': 'url 320w, url 640w', 'jpeg': ...}} for the images on a page
+    sources = [img['filename'] for img in images]
+    if not sources:
+        return {}
+    placeholders = ','.join('?' * len(sources))
+    rows = conn.execute(f"SELECT source, width, format, filename FROM image_derivatives "
+                        f"WHERE source IN ({placeholders}) ORDER BY width", sources).fetchall()
+
+    srcsets = {}
+    for row in rows:
+        entry = f"{url_for('derivative_file', filename=row['filename'])} {row['width']}w"
+        formats = srcsets.setdefault(row['source'], {})
+        formats[row['format']] = f"{formats[row['format']]}, {entry}" if row['format'] in formats else entry
+    return srcsets
+
+# --------------------
+# Perceptual hashes
+# --------------------
+# Hashes of every image live in images.phash. For lookups they are also
+# written to a NumPy file of (id, hash) pairs that each worker memory-maps
+# once; up to PHASH_TAIL_LIMIT rows newer than the file's highest id are read
+# from the DB on the fly, so fresh uploads are searchable before the next
+# rebuild. The file stops short of any recent row whose hash is still being
+# computed, so that row lands in the tail once hashed. The file is rebuilt in
+# the background when the tail fills up, by the upload reconciler, or by
+# `flask build-phash-index`.
+PHASH_DTYPE = [('id', '<i8'), ('hash', '<u8')]
+_phash_index = {'version': None, 'array': None, 'max_id': 0, 'checked': 0.0}
+_phash_index_lock = threading.Lock()
+_phash_rebuild_lock = threading.Lock()
+
+def dct_matrix(n):
+    k = np.arange(n)
+    m = np.cos(np.pi * (2 * k[None, :] + 1) * k[:, None] / (2 * n)) * np.sqrt(2 / n)
+    m[0] /= np.sqrt(2)
+    return m
+
+def compute_phash(path):
+    # DCT perceptual hash: 32x32 greyscale, keep the 8x8 lowest frequencies,
+    # one bit per coefficient above their median. Runs in worker processes too.
+    with Image.open(path) as im:
+        im.draft('L', (64, 64))  # JPEG decodes straight to a small greyscale image
+        pixels = np.asarray(im.convert('L').resize((32, 32), Image.LANCZOS), dtype=np.float64)
+    dct = dct_matrix(32)
+    low = (dct @ pixels @ dct.T)[:8, :8].flatten()
+    bits = low > np.median(low[1:])
+    return int(np.packbits(bits).view('>u8')[0])
+
+def to_signed(phash):
+    return phash - (1 << 64) if phash >= 1 << 63 else phash
+
+def to_unsigned(values):
+    return np.asarray(values, dtype=np.int64).view(np.uint64)
+
+_POPCOUNT8 = None
+
+def hamming(hashes, query):
+    x = hashes ^ np.uint64(query)
+    if hasattr(np, 'bitwise_count'):  # NumPy >= 2.0
+        return np.bitwise_count(x)
+    global _POPCOUNT8
+    if _POPCOUNT8 is None:
+        _POPCOUNT8 = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+    return _POPCOUNT8[x.view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+def build_phash_index(conn):
+    # Rows without a hash among the newest PHASH_TAIL_LIMIT // 2 are taken to be
+    # still in the pool; older ones failed and wait for `flask backfill-phashes`
+    first_pending = conn.execute('''
+        SELECT MIN(id) FROM images
+        WHERE phash IS NULL AND id > (SELECT COALESCE(MAX(id), 0) FROM images) - ?
+    ''', (PHASH_TAIL_LIMIT // 2,)).fetchone()[0]
+    rows = conn.execute("SELECT id, phash FROM images WHERE phash IS NOT NULL AND (? IS NULL OR id < ?) ORDER BY id",
+                        (first_pending, first_pending)).fetchall()
+    array = np.empty(len(rows), dtype=PHASH_DTYPE)
+    if rows:
+        ids, hashes = zip(*rows)
+        array['id'] = ids
+        array['hash'] = to_unsigned(hashes)
+    # Unique temp name: several workers may rebuild at once
+    tmp_path = f"{PHASH_INDEX_PATH}.{uuid.uuid4().hex}.tmp.npy"
+    np.save(tmp_path, array)
+    os.replace(tmp_path, PHASH_INDEX_PATH)
+    with _phash_index_lock:
+        _phash_index['checked'] = 0.0  # pick it up on the next lookup
+    return len(array)
+
+def rebuild_phash_index_async():
+    if not _phash_rebuild_lock.acquire(blocking=False):
+        return  # a rebuild is already running in this process
+
+    def run():
+        conn = acquire_connection()
+        try:
+            build_phash_index(conn)
+        except Exception:
+            app.logger.exception("Perceptual hash index rebuild failed")
+        finally:
+            release_connection(conn)
+            _phash_rebuild_lock.release()
+
+    threading.Thread(target=run, name='phash-index', daemon=True).start()
+
+def load_phash_index():
+    # Re-stat the file at most every few seconds; remap when a rebuild replaced it
+    with _phash_index_lock:
+        now = time.monotonic()
+        if now - _phash_index['checked'] > 5:
+            _phash_index['checked'] = now
+            try:
+                st = os.stat(PHASH_INDEX_PATH)
+                version = (st.st_ino, st.st_mtime_ns)
+            except FileNotFoundError:
+                version = None
+            if _phash_index['array'] is None or version != _phash_index['version']:
+                array = np.load(PHASH_INDEX_PATH, mmap_mode='r') if version else np.empty(0, dtype=PHASH_DTYPE)
+                _phash_index.update(version=version, array=array,
+                                    max_id=int(array['id'][-1]) if len(array) else 0)
+        return _phash_index['array'], _phash_index['max_id']
+
+def find_similar(conn, phash, max_distance, limit, exclude_id=None):
+    # [(image_id, distance)] closest first
+    if np is None:
+        return []
+    array, max_id = load_phash_index()
+    ids, distances = [], []
+    if len(array):
+        d = hamming(array['hash'], phash)
+        hits = np.flatnonzero(d <= max_distance)
+        ids.append(array['id'][hits])
+        distances.append(d[hits])
+
+    # Newest first, so a backlog past the cap still leaves fresh uploads searchable
+    recent = conn.execute("SELECT id, phash FROM images WHERE id > ? AND phash IS NOT NULL ORDER BY id DESC LIMIT ?",
+                          (max_id, PHASH_TAIL_LIMIT)).fetchall()
+    if len(recent) >= PHASH_TAIL_LIMIT:
+        rebuild_phash_index_async()
+    if recent:
+        recent_ids, recent_hashes = (np.asarray(column) for column in zip(*recent))
+        d = hamming(to_unsigned(recent_hashes), phash)
+        hits = np.flatnonzero(d <= max_distance)
+        ids.append(recent_ids[hits].astype(np.int64))
+        distances.append(d[hits])
+
+    if not ids:
+        return []
+    ids, distances = np.concatenate(ids), np.concatenate(distances)
+    keep = ids != exclude_id if exclude_id is not None else slice(None)
+    ids, distances = ids[keep], distances[keep]
+    order = np.lexsort((-ids, distances))[:limit]
+    return [(int(ids[i]), int(distances[i])) for i in order]
+
+def visible_images(conn, matches, user_id):
+    # Resolve (id, distance) matches to rows the user may see: public or their own.
+    # Also drops ids deleted since the index was built.
+    if not matches:
+        return []
+    placeholders = ','.join('?' * len(matches))
+    rows = conn.execute(f"SELECT images.id, images.filename, users.username AS uploader, images.privacy "
+                        f"FROM images JOIN users ON users.id = images.user_id "
+                        f"WHERE images.id IN ({placeholders}) AND (images.privacy = 'public' OR images.user_id = ?)",
+                        [image_id for image_id, _ in matches] + [user_id]).fetchall()
+    by_id = {row['id']: row for row in rows}
+    return [(by_id[image_id], distance) for image_id, distance in matches if image_id in by_id]
+
+def known_phash(conn, source):
+    # Another row with the same blob already has the hash
+    row = conn.execute("SELECT phash FROM images WHERE filename = ? AND phash IS NOT NULL LIMIT 1",
+                       (source,)).fetchone()
+    return row['phash'] if row else None
+
+def record_phash(source, phash):
+    # Called from pool callback threads, outside any request
+    conn = acquire_connection()
+    try:
+        conn.execute("UPDATE images SET phash = ? WHERE filename = ? AND phash IS NULL", (to_signed(phash), source))
+        conn.commit()
+    finally:
+        release_connection(conn)
+
+def schedule_phash(source):
+    # Hash in the thumbnail pool like the derivatives; the future is returned
+    # so an upload can briefly wait on it for the duplicate warning
+    if np is None or Image is None:
+        return None
+
+    def done(future):
+        try:
+            record_phash(source, future.result())
+        except Exception:
+            app.logger.exception("Perceptual hash failed for %s", source)
+
+    try:
+        future = submit_image_job(compute_phash, storage_path(source))
+    except Exception:
+        app.logger.exception("Could not schedule perceptual hash for %s", source)
+        return None  # `flask backfill-phashes` picks it up
+    future.add_done_callback(done)
+    return future
+
+# --------------------
+# Password hashing
+# --------------------
+class PasswordHasherBusy(Exception):
+    pass
+
+_password_pool = None
+_password_pool_lock = threading.Lock()
+_password_slots = threading.BoundedSemaphore(PASSWORD_QUEUE_LIMIT)
+_current_hash_prefix = None
+
+def get_password_pool():
+    global _password_pool
+    with _password_pool_lock:
+        if _password_pool is None:
+            _password_pool = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS)
+        return _password_pool
+
+def discard_password_pool(pool):
+    # A dead worker breaks the executor for good; the next job gets a fresh one
+    global _password_pool
+    app.logger.warning("Password pool broken; starting a new one")
+    with _password_pool_lock:
+        if _password_pool is pool:
+            _password_pool = None
+    pool.shutdown(wait=False)
+
+def run_password_job(operation, fn, *args):
+    # Admission control: fail fast when the pool is saturated rather than queueing without bound
+    if not _password_slots.acquire(blocking=False):
+        PASSWORD_REJECTIONS.inc(reason='busy')
+        raise PasswordHasherBusy()
+    started = time.perf_counter()
+    pool = get_password_pool()
+    try:
+        future = pool.submit(fn, *args)
+    except BrokenProcessPool:
+        _password_slots.release()
+        discard_password_pool(pool)
+        PASSWORD_REJECTIONS.inc(reason='broken')
+        raise PasswordHasherBusy()
+    except BaseException:
+        _password_slots.release()
+        raise
+    # The slot is held until the job leaves the pool, not until we stop
+    # waiting, so timed-out jobs still count against PASSWORD_QUEUE_LIMIT
+    future.add_done_callback(lambda _: _password_slots.release())
+    try:
+        return future.result(timeout=PASSWORD_HASH_TIMEOUT)
+    except FutureTimeoutError:
+        future.cancel()  # if still queued, don't spend CPU on a request that has been answered
+        PASSWORD_REJECTIONS.inc(reason='timeout')
+        raise PasswordHasherBusy()
+    except BrokenProcessPool:
+        discard_password_pool(pool)
+        PASSWORD_REJECTIONS.inc(reason='broken')
+        raise PasswordHasherBusy()
+    finally:
+        PASSWORD_HASH_SECONDS.observe(time.perf_counter() - started, operation=operation)
+
+def hash_password(password):
+    return run_password_job('generate', generate_password_hash, password, PASSWORD_HASH_METHOD)
+
+def verify_password(pwhash, password):
+    return run_password_job('check', check_password_hash, pwhash, password)
+
+def needs_rehash(pwhash):
+    # Stored hashes look like 'scrypt:32768:8:1$salt$hash'; compare the
+    # parameters with what PASSWORD_HASH_METHOD produces today
+    global _current_hash_prefix
+    if _current_hash_prefix is None:
+        try:
+            _current_hash_prefix = hash_password('').split('$', 1)[0]
+        except PasswordHasherBusy:
+            return False  # the login already succeeded; rehash on a later one
+    return pwhash.split('$', 1)[0] != _current_hash_prefix
+
+class RateLimiter:
+    # Sliding-window counter per key (client IP, username)
+    def __init__(self, limit, window=RATE_LIMIT_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.hits = {}
+        self.lock = threading.Lock()
+        self.next_sweep = time.monotonic() + window
+
+    def _recent(self, key, now):
+        hits = [t for t in self.hits.get(key, ()) if t > now - self.window]
+        if hits:
+            self.hits[key] = hits
+        else:
+            self.hits.pop(key, None)
+        return hits
+
+    def _sweep(self, now):
+        # Forget idle keys so a spray of usernames or IPs can't grow memory forever
+        if now >= self.next_sweep:
+            for key in list(self.hits):
+                self._recent(key, now)
+            self.next_sweep = now + self.window
+
+    def limited(self, key):
+        with self.lock:
+            now = time.monotonic()
+            self._sweep(now)
+            return len(self._recent(key, now)) >= self.limit
+
+    def hit(self, key):
+        with self.lock:
+            self.hits.setdefault(key, []).append(time.monotonic())
+
+login_attempts_by_ip = RateLimiter(LOGIN_LIMIT_PER_IP)
+login_failures_by_user = RateLimiter(LOGIN_FAILURE_LIMIT_PER_USER)
+
+def rate_limited(username=None):
+    ip = request.remote_addr or 'unknown'
+    if login_attempts_by_ip.limited(ip) or (username and login_failures_by_user.limited(username.lower())):
+        PASSWORD_REJECTIONS.inc(reason='rate_limited')
+        return True
+    login_attempts_by_ip.hit(ip)
+    return False
+
 # --------------------
 # Routes
 # --------------------
@@ -79,15 +1245,31 @@ def login():
         username = request.form['username']
         password = request.form['password']
 
+        if rate_limited(username):
+            flash("Too many login attempts. Please wait a minute and try again.")
+            return render_template("login.html"), 429
+
         conn = get_db_connection()
         user = conn.execute("SELECT * FROM users WHERE username = ?", (username,)).fetchone()
-        conn.close()
 
-        if user and check_password_hash(user['password'], password):
-            session['username'] = user['username']
-            return redirect(url_for('main'))
-        else:
-            flash("Invalid username or password")
+        try:
+            if user and verify_password(user['password'], password):
+                # Upgrade hashes made with older parameters while we have the plain password
+                if needs_rehash(user['password']):
+                    try:
+                        conn.execute("UPDATE users SET password = ? WHERE id = ?", (hash_password(password), user['id']))
+                        conn.commit()
+                    except PasswordHasherBusy:
+                        pass  # still logged in; the upgrade waits for a later login
+                session['username'] = user['username']
+                session['user_id'] = user['id']
+                return redirect(url_for('main'))
+            else:
+                login_failures_by_user.hit(username.lower())
+                flash("Invalid username or password")
+        except PasswordHasherBusy:
+            flash("The server is busy. Please try again in a moment.")
+            return render_template("login.html"), 503
     
     return render_template("login.html")
 
@@ -103,24 +1285,35 @@ def register():
             flash("All fields are required")
         elif password != confirm:
             flash("Passwords do not match")
+        elif rate_limited():
+            flash("Too many attempts. Please wait a minute and try again.")
+            return render_template('register.html'), 429
         else:
             conn = get_db_connection()
             try:
-                hashed = generate_password_hash(password)
+                hashed = hash_password(password)
                 conn.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, hashed))
                 conn.commit()
                 flash("Registration successful. Please log in.")
                 return redirect(url_for('login'))
             except sqlite3.IntegrityError:
                 flash("Username already exists")
-            finally:
-                conn.close()
+            except PasswordHasherBusy:
+                flash("The server is busy. Please try again in a moment.")
+                return render_template('register.html'), 503
     return render_template('register.html')
 
 # Serve uploaded images
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_immutable(app.config['UPLOAD_FOLDER'], storage_relpath(filename), filename,
+                          app.config['X_ACCEL_PREFIX'])
+
+# Serve resized copies of uploaded images
+@app.route('/thumbs/<filename>')
+def derivative_file(filename):
+    return send_immutable(app.config['THUMBNAIL_FOLDER'], filename, filename,
+                          app.config['X_ACCEL_THUMBS_PREFIX'])
 
 # Main page (public images only)
 @app.route('/main')
@@ -129,18 +1322,30 @@ def main():
         return redirect(url_for('login'))
 
     conn = get_db_connection()
-    rows = conn.execute("SELECT filename, uploader, privacy FROM images WHERE privacy='public' ORDER BY id DESC").fetchall()
+    cursor = get_cursor()
 
-    images = []
-    for row in rows:
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], row['filename'])
-        if os.path.exists(filepath):
-            images.append((row['filename'], row['uploader'], row['privacy']))
-        else:
-            conn.execute("DELETE FROM images WHERE filename = ?", (row['filename'],))
-            conn.commit()
-    conn.close()
-    return render_template('main_page.html', username=session['username'], images=images)
+    def build():
+        images, next_cursor = fetch_public_page(conn, cursor)
+        return render_template('_gallery_grid.html', images=images, next_cursor=next_cursor,
+                               srcsets=get_srcsets(conn, images))
+
+    grid = cached(conn, ('gallery',), ('main', cursor), build)
+    return render_template('main_page.html', username=session['username'], grid=Markup(grid))
+
+# JSON feed of public images for infinite scroll
+@app.route('/api/feed')
+def feed():
+    if 'username' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    conn = get_db_connection()
+    cursor = get_cursor()
+
+    def build():
+        images, next_cursor = fetch_public_page(conn, cursor)
+        return feed_json(images, next_cursor, get_srcsets(conn, images))
+
+    return json_response(cached(conn, ('gallery',), ('feed', cursor), build))
 
 # Your media page (private + public)
 @app.route('/media')
@@ -149,19 +1354,65 @@ def media():
         return redirect(url_for('login'))
 
     username = session['username']
+    user_id = current_user_id()
     conn = get_db_connection()
-    rows = conn.execute("SELECT filename, privacy FROM images WHERE uploader = ?", (username,)).fetchall()
+    cursor = get_cursor()
 
-    images = []
-    for row in rows:
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], row['filename'])
-        if os.path.exists(filepath):
-            images.append((row['filename'], row['privacy']))
-        else:
-            conn.execute("DELETE FROM images WHERE filename = ?", (row['filename'],))
-            conn.commit()
-    conn.close()
-    return render_template('your_media.html', username=username, images=images)
+    def build():
+        images, next_cursor = fetch_user_page(conn, user_id, cursor)
+        return render_template('_media_grid.html', images=images, next_cursor=next_cursor,
+                               srcsets=get_srcsets(conn, images))
+
+    grid = cached(conn, (user_namespace(user_id),), ('media', user_id, cursor), build)
+    return render_template('your_media.html', username=username, grid=Markup(grid))
+
+# JSON feed of the logged-in user's images (private + public)
+@app.route('/api/media')
+def media_feed():
+    if 'username' not in session:
+        return jsonify({'error': 'login required'}), 401
+
+    user_id = current_user_id()
+    conn = get_db_connection()
+    cursor = get_cursor()
+
+    def build():
+        images, next_cursor = fetch_user_page(conn, user_id, cursor)
+        return feed_json(images, next_cursor, get_srcsets(conn, images))
+
+    return json_response(cached(conn, (user_namespace(user_id),), ('media_feed', user_id, cursor), build))
+
+# Images that look like a given image
+@app.route('/api/similar/<int:image_id>')
+def similar(image_id):
+    if 'username' not in session:
+        return jsonify({'error': 'login required'}), 401
+    if np is None:
+        return jsonify({'error': 'similar-image search is not available'}), 501
+
+    user_id = current_user_id()
+    conn = get_db_connection()
+    image = conn.execute("SELECT phash FROM images WHERE id = ? AND (privacy = 'public' OR user_id = ?)",
+                         (image_id, user_id)).fetchone()
+    if image is None:
+        return jsonify({'error': 'image not found'}), 404
+    if image['phash'] is None:
+        return jsonify({'error': 'image has not been hashed yet'}), 409
+
+    max_distance = min(request.args.get('distance', PHASH_SIMILAR_DISTANCE, type=int), 32)
+    limit = min(request.args.get('limit', PAGE_SIZE, type=int), 100)
+    # Ask for extra matches since some may be private to other users
+    matches = find_similar(conn, image['phash'] & ((1 << 64) - 1), max_distance, limit * 4, exclude_id=image_id)
+    results = visible_images(conn, matches, user_id)[:limit]
+    return jsonify({
+        'images': [{
+            'id': row['id'],
+            'url': url_for('uploaded_file', filename=row['filename']),
+            'uploader': row['uploader'],
+            'privacy': row['privacy'],
+            'distance': distance,
+        } for row, distance in results],
+    })
 
 # Upload image
 @app.route('/upload', methods=['GET', 'POST'])
@@ -185,18 +1436,31 @@ def upload():
             flash("Invalid file type. Only images are allowed.")
             return redirect(url_for('upload'))
 
-        safe_name = secure_filename(file.filename)
-        unique_name = f"{uuid.uuid4().hex}_{safe_name}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_name)
-        file.save(filepath)
+        ext = file.filename.rsplit('.', 1)[1].lower()
 
         conn = get_db_connection()
-        conn.execute("INSERT INTO images (filename, uploader, privacy) VALUES (?, ?, ?)", 
-                     (unique_name, session['username'], privacy))
+        stored_name, is_new_file = store_upload(conn, file, ext)
+        phash = None if is_new_file else known_phash(conn, stored_name)
+        image_id = conn.execute("INSERT INTO images (filename, user_id, privacy, phash) VALUES (?, ?, ?, ?)", 
+                                (stored_name, current_user_id(), privacy, phash)).lastrowid
+        invalidate(conn, user_namespace(current_user_id()), *(['gallery'] if privacy == 'public' else []))
         conn.commit()
-        conn.close()
+        # Hash first so the duplicate check isn't queued behind the thumbnails
+        phash_future = schedule_phash(stored_name) if phash is None else None
+        if is_new_file:
+            schedule_derivatives(stored_name)
 
         flash("Image uploaded successfully!")
+        if phash_future is not None and app.config['DUPLICATE_WARNING']:
+            try:
+                phash = phash_future.result(timeout=PHASH_WARNING_TIMEOUT)
+            except Exception:
+                pass  # no warning this time; the callback still stores the hash
+        if phash is not None and app.config['DUPLICATE_WARNING']:
+            # Ask for extra matches since some may be private to other users
+            matches = find_similar(conn, phash & ((1 << 64) - 1), PHASH_DUPLICATE_DISTANCE, 4, exclude_id=image_id)
+            if visible_images(conn, matches, current_user_id()):
+                flash("Heads up: this looks like a near-duplicate of an image that is already uploaded.")
         return redirect(url_for('media'))
 
     return render_template('upload.html')
@@ -234,10 +1498,16 @@ def settings():
         return redirect(url_for('login'))
 
     username = session['username']
+    user_id = current_user_id()
     conn = get_db_connection()
-    rows = conn.execute("SELECT filename, privacy FROM images WHERE uploader = ?", (username,)).fetchall()
-    conn.close()
-    return render_template("settings.html", username=username, images=rows)
+
+    def build():
+        rows = conn.execute("SELECT filename, privacy FROM images WHERE user_id = ? ORDER BY id DESC",
+                            (user_id,)).fetchall()
+        return render_template("_settings_grid.html", images=rows, srcsets=get_srcsets(conn, rows))
+
+    grid = cached(conn, (user_namespace(user_id),), ('settings', user_id), build)
+    return render_template("settings.html", username=username, grid=Markup(grid))
 
 
 @app.route('/change_username', methods=['POST'])
@@ -245,7 +1515,6 @@ def change_username():
     if 'username' not in session:
         return redirect(url_for('login'))
 
-    old_username = session['username']
     new_username = request.form['new_username'].strip()
 
     if not new_username:
@@ -254,19 +1523,14 @@ def change_username():
 
     conn = get_db_connection()
     try:
-        # Update the username in users table
-        conn.execute("UPDATE users SET username = ? WHERE username = ?", (new_username, old_username))
-        
-        # Update the uploader field in images table for this user
-        conn.execute("UPDATE images SET uploader = ? WHERE uploader = ?", (new_username, old_username))
-        
+        # Images reference users.id, so this is the only row that changes
+        conn.execute("UPDATE users SET username = ? WHERE id = ?", (new_username, current_user_id()))
+        invalidate(conn, 'gallery', user_namespace(current_user_id()))  # uploader names in the feeds
         conn.commit()
         session['username'] = new_username
         flash("Username updated successfully, and all your uploads are now linked to your new username!")
     except sqlite3.IntegrityError:
         flash("Username already taken.")
-    finally:
-        conn.close()
 
     return redirect(url_for('settings'))
 
@@ -282,21 +1546,280 @@ def change_password():
     confirm = request.form['confirm_password']
 
     conn = get_db_connection()
-    user = conn.execute("SELECT * FROM users WHERE username = ?", (session['username'],)).fetchone()
+    user = conn.execute("SELECT * FROM users WHERE id = ?", (current_user_id(),)).fetchone()
 
-    if not check_password_hash(user['password'], current):
-        flash("Current password is incorrect.")
-    elif new_pass != confirm:
-        flash("New passwords do not match.")
-    else:
-        hashed = generate_password_hash(new_pass)
-        conn.execute("UPDATE users SET password = ? WHERE username = ?", (hashed, session['username']))
-        conn.commit()
-        flash("Password updated successfully!")
+    try:
+        if rate_limited(user['username']):
+            flash("Too many attempts. Please wait a minute and try again.")
+        elif not verify_password(user['password'], current):
+            login_failures_by_user.hit(user['username'].lower())
+            flash("Current password is incorrect.")
+        elif new_pass != confirm:
+            flash("New passwords do not match.")
+        else:
+            hashed = hash_password(new_pass)
+            conn.execute("UPDATE users SET password = ? WHERE id = ?", (hashed, current_user_id()))
+            conn.commit()
+            flash("Password updated successfully!")
+    except PasswordHasherBusy:
+        flash("The server is busy. Please try again in a moment.")
 
-    conn.close()
     return redirect(url_for('settings'))
 
 
+# --------------------
+# Upload reconciler
+# --------------------
+# Request handlers trust the images table; keeping it in sync with
+# UPLOAD_FOLDER is done here in bulk, either from the CLI
+# (`flask --app website reconcile-uploads`) or from a background thread
+# when RECONCILE_INTERVAL is set.
+RECONCILE_BATCH_SIZE = 500
+RECONCILE_GRACE_SECONDS = 300  # files younger than this may belong to an upload still in flight
+
+def scan_uploads(folder):
+    # {name: (path, mtime)} for every stored upload: flat legacy files and sharded blobs (ab/cd/<name>)
+    found = {}
+
+    def walk(path, depth):
+        count_fs('scandir')
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.name.startswith('.'):
+                    continue
+                if entry.is_dir():
+                    if depth < 2:
+                        walk(entry.path, depth + 1)
+                elif entry.is_file():
+                    found[entry.name] = (entry.path, entry.stat().st_mtime)
+
+    walk(folder, 0)
+    return found
+
+def reconcile_uploads(batch_size=RECONCILE_BATCH_SIZE, grace_seconds=RECONCILE_GRACE_SECONDS, dry_run=False):
+    folder = app.config['UPLOAD_FOLDER']
+    started = time.monotonic()
+    cutoff = time.time() - grace_seconds
+
+    conn = acquire_connection()  # may run on the reconciler thread, outside any app context
+    # Rows committed after this point may point at files the scan below
+    # missed, so only rows that already existed can be judged as missing
+    max_image_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM images").fetchone()[0]
+    max_blob_id = conn.execute("SELECT COALESCE(MAX(rowid), 0) FROM blobs").fetchone()[0]
+
+    on_disk = scan_uploads(folder)
+
+    missing = []
+    referenced = set()
+    scanned_rows = 0
+    for image_id, filename in conn.execute("SELECT id, filename FROM images"):
+        scanned_rows += 1
+        if filename in on_disk or image_id > max_image_id:
+            referenced.add(filename)
+        else:
+            missing.append((image_id, filename))
+
+    missing_blobs = []
+    for blob_id, name in conn.execute("SELECT rowid, name FROM blobs"):
+        if name in on_disk or blob_id > max_blob_id:
+            referenced.add(name)
+        else:
+            missing_blobs.append(name)
+
+    # Whatever is left on disk has no row pointing at it
+    orphans = [(name, path) for name, (path, mtime) in on_disk.items()
+               if name not in referenced and mtime < cutoff]
+
+    # Temp files left behind by uploads that died mid-stream
+    stale_temps = []
+    tmp_dir = os.path.join(folder, '.tmp')
+    if os.path.isdir(tmp_dir):
+        with os.scandir(tmp_dir) as entries:
+            stale_temps = [entry.path for entry in entries if entry.stat().st_mtime < cutoff]
+
+    def still_missing(name):
+        # Re-check just before deleting; the scan may be minutes old by now
+        count_fs('stat')
+        return not os.path.exists(storage_path(name))
+
+    unreferenced_blobs = 0
+    phash_indexed = None
+    missing_files = set()
+    if not dry_run:
+        for i in range(0, len(missing), batch_size):
+            batch = [(image_id, filename) for image_id, filename in missing[i:i + batch_size]
+                     if still_missing(filename)]
+            if not batch:
+                continue
+            missing_files.update(filename for _, filename in batch)
+            placeholders = ','.join('?' * len(batch))
+            conn.execute(f"DELETE FROM images WHERE id IN ({placeholders})", [image_id for image_id, _ in batch])
+            invalidate(conn, 'images')
+            conn.commit()
+
+        for i in range(0, len(missing_blobs), batch_size):
+            batch = [name for name in missing_blobs[i:i + batch_size] if still_missing(name)]
+            if not batch:
+                continue
+            placeholders = ','.join('?' * len(batch))
+            conn.execute(f"DELETE FROM blobs WHERE name IN ({placeholders})", batch)
+            conn.commit()
+
+        for _, path in orphans:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        for path in stale_temps:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        delete_derivatives(conn, missing_files.union(name for name, _ in orphans))
+
+        # Recount references so blobs whose images are gone get released
+        conn.execute("UPDATE blobs SET refcount = (SELECT COUNT(*) FROM images WHERE images.filename = blobs.name)")
+        conn.commit()
+        unreferenced_blobs = drop_unreferenced_blobs(conn)
+
+        # Fold new hashes into the memory-mapped index and drop purged rows from it
+        if np is not None:
+            phash_indexed = build_phash_index(conn)
+    release_connection(conn)
+
+    report = {
+        'scanned_files': len(on_disk),
+        'scanned_rows': scanned_rows,
+        'rows_without_file': len(missing),
+        'blobs_without_file': len(missing_blobs),
+        'files_without_row': len(orphans),
+        'unreferenced_blobs': unreferenced_blobs,
+        'stale_temp_files': len(stale_temps),
+        'phash_indexed': phash_indexed,
+        'dry_run': dry_run,
+        'seconds': round(time.monotonic() - started, 3),
+    }
+    app.logger.info("Upload reconcile: %s", report)
+    return report
+
+@app.cli.command('reconcile-uploads')
+@click.option('--batch-size', default=RECONCILE_BATCH_SIZE, show_default=True, help="Rows deleted per transaction.")
+@click.option('--grace', default=RECONCILE_GRACE_SECONDS, show_default=True, help="Skip files modified within this many seconds.")
+@click.option('--dry-run', is_flag=True, help="Report what would be purged without changing anything.")
+def reconcile_uploads_command(batch_size, grace, dry_run):
+    """Purge image rows without files, files without image rows and unreferenced blobs."""
+    report = reconcile_uploads(batch_size, grace, dry_run)
+    for key, value in report.items():
+        click.echo(f"{key}: {value}")
+
+def start_reconciler(interval):
+    def run():
+        while True:
+            time.sleep(interval)
+            try:
+                reconcile_uploads()
+            except Exception:
+                app.logger.exception("Upload reconcile failed")
+
+    thread = threading.Thread(target=run, name='upload-reconciler', daemon=True)
+    thread.start()
+    return thread
+
+if os.environ.get('RECONCILE_INTERVAL'):
+    start_reconciler(int(os.environ['RECONCILE_INTERVAL']))
+
+@app.cli.command('backfill-thumbnails')
+@click.option('--all', 'redo_all', is_flag=True, help="Regenerate thumbnails that already exist.")
+def backfill_thumbnails_command(redo_all):
+    """Generate thumbnails for uploads that do not have them yet."""
+    if Image is None:
+        raise click.ClickException("Pillow is required to generate thumbnails.")
+
+    conn = get_db_connection()
+    sql = "SELECT DISTINCT filename FROM images"
+    if not redo_all:
+        sql += " WHERE filename NOT IN (SELECT source FROM image_derivatives)"
+    sources = [row['filename'] for row in conn.execute(sql)]
+
+    futures = {submit_derivatives(source): source for source in sources}
+    done = failed = 0
+    for future in as_completed(futures):
+        source = futures[future]
+        try:
+            record_derivatives(source, future.result())
+            done += 1
+        except Exception as e:
+            failed += 1
+            click.echo(f"{source}: {e}", err=True)
+    click.echo(f"Thumbnails generated for {done} images ({failed} failed).")
+
+@app.cli.command('migrate-storage')
+def migrate_storage_command():
+    """Move flat uuid_name uploads into content-addressed, sharded storage."""
+    folder = app.config['UPLOAD_FOLDER']
+    with os.scandir(folder) as entries:
+        legacy = [entry.name for entry in entries
+                  if entry.is_file() and not entry.name.startswith('.') and not BLOB_NAME.match(entry.name)]
+
+    conn = get_db_connection()
+    moved = deduplicated = skipped = 0
+    for old_name in legacy:
+        refs = conn.execute("SELECT COUNT(*) FROM images WHERE filename = ?", (old_name,)).fetchone()[0]
+        if refs == 0 or '.' not in old_name:
+            skipped += 1  # left for reconcile-uploads
+            continue
+
+        ext = old_name.rsplit('.', 1)[1].lower()
+        old_path = os.path.join(folder, old_name)
+        # Hash through a temp copy so the original stays readable until the rows are switched over
+        with open(old_path, 'rb') as f:
+            tmp_path, sha, size = hash_to_temp(f)
+        new_name, is_new_file = add_blob(conn, tmp_path, sha, size, ext, refs)
+        conn.execute("UPDATE images SET filename = ? WHERE filename = ?", (new_name, old_name))
+        if is_new_file:
+            conn.execute("UPDATE OR IGNORE image_derivatives SET source = ? WHERE source = ?", (new_name, old_name))
+        conn.commit()
+        delete_derivatives(conn, [old_name])  # only duplicates are left under the old name
+        os.remove(old_path)
+
+        if is_new_file:
+            moved += 1
+        else:
+            deduplicated += 1
+
+    if moved or deduplicated:
+        invalidate(conn, 'images')
+        conn.commit()
+    click.echo(f"Moved {moved} files, deduplicated {deduplicated}, skipped {skipped} unreferenced.")
+
+@app.cli.command('build-phash-index')
+def build_phash_index_command():
+    """Rewrite the memory-mapped perceptual hash index from images.phash."""
+    if np is None:
+        raise click.ClickException("NumPy is required for the perceptual hash index.")
+    click.echo(f"Indexed {build_phash_index(get_db_connection())} images in {PHASH_INDEX_PATH}.")
+
+@app.cli.command('backfill-phashes')
+def backfill_phashes_command():
+    """Compute perceptual hashes for images that lack one, then rebuild the index."""
+    if np is None or Image is None:
+        raise click.ClickException("NumPy and Pillow are required for perceptual hashes.")
+
+    conn = get_db_connection()
+    sources = [row['filename'] for row in conn.execute("SELECT DISTINCT filename FROM images WHERE phash IS NULL")]
+    futures = {submit_image_job(compute_phash, storage_path(source)): source for source in sources}
+    done = failed = 0
+    for future in as_completed(futures):
+        source = futures[future]
+        try:
+            conn.execute("UPDATE images SET phash = ? WHERE filename = ?", (to_signed(future.result()), source))
+            conn.commit()
+            done += 1
+        except Exception as e:
+            failed += 1
+            click.echo(f"{source}: {e}", err=True)
+    click.echo(f"Hashed {done} files ({failed} failed).")
+    click.echo(f"Indexed {build_phash_index(conn)} images in {PHASH_INDEX_PATH}.")
+
 if __name__ == '__main__':
     app.run(debug=True)